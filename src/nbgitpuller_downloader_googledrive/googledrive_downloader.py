@@ -1,9 +1,22 @@
+import json
+import logging
+import os
 import re
-import requests
+import tempfile
+from functools import partial
+from urllib.parse import unquote
 from nbgitpuller.plugin_hook_specs import hookimpl
-from nbgitpuller_downloader_plugins_util.plugin_helper import HandleFilesHelper
+from nbgitpuller_downloader_plugins_util.plugin_helper import HandleFilesHelper, save_response_content, create_session, \
+    get_local_origin_repo, get_source_path_part, is_initialized_repo, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
 
 DOWNLOAD_URL = "https://docs.google.com/uc?export=download"
+CONTENT_DISPOSITION_FILENAME = re.compile(r'filename(\*?)=([^;]+)')
+# the ETag, Last-Modified date and directory name of each downloaded file, by the name of its local origin repo;
+# later pulls send them back as conditional headers and skip the import entirely when nothing changed
+DOWNLOAD_METADATA_CACHE = ".nbgitpuller/meta_cache.json"
+
+# reused across downloads so the confirmation request, and later pulls, go over an already open connection
+_SESSION = create_session()
 
 
 @hookimpl
@@ -19,18 +32,104 @@ def prepare_non_git_source_local_origin(git_puller_ref):
     :rtype json object
     """
     repo = git_puller_ref.git_url
+    file_id = get_id(repo)
+    local_origin_repo = get_local_origin_repo(git_puller_ref)
+    metadata_cache_file = f"{git_puller_ref.repo_parent_dir}{DOWNLOAD_METADATA_CACHE}"
+    # keyed like the local origin repo so the metadata always describes what was pushed to it
+    metadata_key = get_source_path_part(repo)
+    metadata = load_download_metadata(metadata_cache_file).get(metadata_key)
+    if not is_initialized_repo(local_origin_repo):
+        metadata = None
+
     yield "Determining type of archive...\n"
-    response = get_response_from_drive(DOWNLOAD_URL, get_id(repo))
-    ext = determine_file_extension_from_response(response)
-    yield f"Archive is: {ext}\n"
-    git_puller_ref.other_kw_args["extension"] = ext
-    git_puller_ref.other_kw_args["download_func"] = download_archive_for_google
-
-    hfh = HandleFilesHelper(git_puller_ref)
-    output_info = yield from hfh.handle_files_helper()
+    # the response used to find the extension is kept open and its body becomes the download; if its connection
+    # is dropped while it sits idle as the repos are prepared, save_response_content requests the file again
+    response = get_response_from_drive(DOWNLOAD_URL, file_id, get_conditional_headers(metadata))
+    try:
+        if response.status_code == 304:
+            yield "Archive has not changed since it was last imported\n"
+            return {"source_dir_name": metadata["source_dir_name"], "local_origin_repo_path": local_origin_repo}
+
+        ext = determine_file_extension_from_response(response)
+        yield f"Archive is: {ext}\n"
+        git_puller_ref.other_kw_args["extension"] = ext
+        git_puller_ref.other_kw_args["download_func"] = download_archive_for_google
+        git_puller_ref.other_kw_args["download_func_params"] = {"source_url": repo, "response": response}
+        git_puller_ref.other_kw_args["stream_download"] = True
+        content_length = response.headers.get("content-length")
+        if content_length and content_length.isdigit() and not response.headers.get("content-encoding"):
+            git_puller_ref.other_kw_args["download_size"] = int(content_length)
+
+        hfh = HandleFilesHelper(git_puller_ref)
+        output_info = yield from hfh.handle_files_helper()
+    finally:
+        response.close()
+
+    etag = response.headers.get("etag")
+    last_modified = response.headers.get("last-modified")
+    if etag or last_modified:
+        save_download_metadata(metadata_cache_file, metadata_key, {
+            "etag": etag,
+            "last_modified": last_modified,
+            "source_dir_name": output_info["source_dir_name"]
+        })
     return output_info
 
 
+def get_conditional_headers(metadata):
+    """
+    Builds the headers that ask Google Drive to answer 304 Not Modified if the file has not changed
+    since it was last downloaded.
+
+    :param dict metadata: the cached metadata of the last download of the file or None
+    :return the request headers
+    :rtype dict
+    """
+    headers = {}
+    if metadata and metadata.get("source_dir_name"):
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+    return headers
+
+
+def load_download_metadata(metadata_cache_file):
+    """
+    Reads the metadata cached for earlier downloads.
+
+    :param str metadata_cache_file: the path to the json cache
+    :return the metadata of each downloaded file by the name of its local origin repo; empty if the cache is missing or unreadable
+    :rtype dict
+    """
+    try:
+        with open(metadata_cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_download_metadata(metadata_cache_file, metadata_key, metadata):
+    """
+    Records the metadata of a download in the cache. The cache is rewritten to a temporary file that then
+    replaces it so a concurrent reader never sees a partly written file.
+
+    :param str metadata_cache_file: the path to the json cache
+    :param str metadata_key: the name of the local origin repo of the downloaded file(see get_source_path_part)
+    :param dict metadata: the etag, last_modified and source_dir_name of the download
+    """
+    cache = load_download_metadata(metadata_cache_file)
+    cache[metadata_key] = metadata
+    cache_dir = os.path.dirname(metadata_cache_file)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, delete=False) as f:
+            json.dump(cache, f)
+        os.replace(f.name, metadata_cache_file)
+    except OSError as ex:
+        logging.warning(f"Could not save the download metadata cache {metadata_cache_file}: {ex}")
+
+
 def get_id(repo):
     """
     This gets the id of the file from the URL.
@@ -44,24 +143,25 @@ def get_id(repo):
     return repo[start_id_index:end_id_index]
 
 
-def get_confirm_token(session):
+def get_confirm_token(response):
     """
     Google may include a confirm dialog if the file is too big. This retrieves the
-    confirmation token and uses it to complete the download.
+    confirmation token and uses it to complete the download. The cookies are read from
+    the response rather than the session because the session is shared between downloads.
 
-    :param session: used to the get the cookies from the response
-    :type session requests.Session
+    :param response: used to the get the cookies set by the request
+    :type response requests.Response
     :return the cookie if found or None if not found
     :rtype str
     """
-    cookies = session.cookies
+    cookies = response.cookies
     for key, cookie in cookies.items():
         if key.startswith('download_warning'):
             return cookie
     return None
 
 
-def download_archive_for_google(source_url=None, temp_download_file=None):
+def download_archive_for_google(source_url=None, temp_download_file=None, response=None):
     """
     This requests the file from the repo(url) given and saves it to the disk. This is executed
     in plugin_helper.py and note that the parameters to this function are the same as the standard
@@ -69,32 +169,22 @@ def download_archive_for_google(source_url=None, temp_download_file=None):
     plugin_helper handle passing the temp_download_file to the function
 
     :param str source_url: the url to compressed archive in GoogleDrove
-    :param str temp_download_file: the path to save the requested file to
+    :param temp_download_file: the path(or binary file object) to save the requested file to
+    :param response: [OPTIONAL] the still unread response from get_response_from_drive; when it is given
+        its body is saved instead of requesting the file again, unless reading it fails
+    :type response requests.Response
     """
     yield "Downloading archive ...\n"
     try:
-        file_id = get_id(source_url)
-        with requests.Session() as session:
-            with session.get(DOWNLOAD_URL, params={'id': file_id}) as response:
-                token = get_confirm_token(session)
-                if token:
-                    params = {'id': file_id, 'confirm': token}
-                    response = session.get(DOWNLOAD_URL, params=params)
-                with open(temp_download_file, 'ab') as f:
-                    count_chunks = 1
-                    for chunk in response.iter_content(chunk_size=1024):
-                        if chunk:
-                            count_chunks += 1
-                            if count_chunks % 1000 == 0:
-                                display = count_chunks / 1000
-                                yield f"Downloading Progress ... {display}MB\n"
-                            f.write(chunk)
+        open_response = partial(get_response_from_drive, DOWNLOAD_URL, get_id(source_url))
+        for progress_msg in save_response_content(open_response, temp_download_file, response):
+            yield progress_msg
         yield "Archive Downloaded....\n"
     except Exception as ex:
         raise ex
 
 
-def get_response_from_drive(url, file_id):
+def get_response_from_drive(url, file_id, headers=None):
     """
     You need to check to see that Google Drive has not asked the
     request to confirm that they disabled the virus scan on files that
@@ -103,19 +193,25 @@ def get_response_from_drive(url, file_id):
     to request again but this time putting the 'confirm=XXX' as a query
     parameter.
 
+    The response is streamed; the caller is responsible for closing it.
+
     :param str url: the Google Drive download URL
     :param str file_id: the Google Drive id of the file to download
+    :param dict headers: [OPTIONAL] extra request headers(e.g. a Range to resume the download)
     :return response object
-    :rtype json object
+    :rtype requests.Response
     """
-    with requests.Session() as session:
-        with session.get(url, params={'id': file_id}) as response:
-            token = get_confirm_token(session)
-            if token:
-                params = {'id': file_id, 'confirm': token}
-                response = session.get(url, params=params)
-                return response
-            return response
+    response = _SESSION.get(url, params={'id': file_id}, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    token = get_confirm_token(response)
+    if token:
+        # reading the short confirmation page releases its connection back to the pool
+        # so the confirmed request below reuses it
+        for _ in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            pass
+        response.close()
+        params = {'id': file_id, 'confirm': token}
+        response = _SESSION.get(url, params=params, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    return response
 
 
 def determine_file_extension_from_response(response):
@@ -128,10 +224,15 @@ def determine_file_extension_from_response(response):
     """
     content_disposition = response.headers.get('content-disposition')
     ext = None
-    if content_disposition:
-        file_name = re.findall("filename\\*?=([^;]+)", content_disposition)
-        file_name = file_name[0].strip().strip('"')
-        ext = file_name.split(".")[1]
+    file_names = dict(CONTENT_DISPOSITION_FILENAME.findall(content_disposition)) if content_disposition else {}
+    if "*" in file_names:
+        # filename*(e.g. UTF-8''archive.zip) takes precedence over filename when both are sent
+        file_name = unquote(file_names["*"].strip().strip('"').split("''", 1)[-1])
+    else:
+        file_name = file_names.get("", "").strip().strip('"')
+    # the last suffix names the compression(e.g. gz for archive.tar.gz)
+    if "." in file_name:
+        ext = file_name.rsplit(".", 1)[-1]
 
     if ext is None:
         message = f"Could not determine compression type of: {content_disposition}"
@@ -1,26 +1,151 @@
-import string
+import hashlib
+import io
 import os
 import logging
+import posixpath
 import subprocess
 import shutil
+import string
 import tempfile
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from contextlib import nullcontext
 from urllib.parse import urlparse
 from functools import partial
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+# not available on Windows, where concurrent pulls of the same archive are not serialized
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # this is the path to the local origin repository that nbgitpuller uses to mimic
 # a remote repo in GitPuller
 CACHED_ORIGIN_NON_GIT_REPO = ".nbgitpuller/targets/"
+# this is the path to the clones of the local origin repositories where archives are unarchived
+# and committed; they are kept between pulls and brought up to date with a fetch
+CACHED_WORKTREE_NON_GIT_REPO = ".nbgitpuller/worktrees/"
+
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 128 * 1024
+BYTES_PER_MB = 1024 * 1024
+
+
+def get_download_chunk_size():
+    """
+    Reads the NBGITPULLER_DOWNLOAD_CHUNK_SIZE environment variable; a value that is not a positive
+    whole number is ignored with a warning so a typo never stops the plugins from loading.
+
+    :return the number of bytes to read and write at a time while downloading
+    :rtype int
+    """
+    value = os.environ.get("NBGITPULLER_DOWNLOAD_CHUNK_SIZE")
+    if value is None:
+        return DEFAULT_DOWNLOAD_CHUNK_SIZE
+    try:
+        chunk_size = int(value)
+    except ValueError:
+        chunk_size = 0
+    if chunk_size <= 0:
+        logging.warning(f"Ignoring NBGITPULLER_DOWNLOAD_CHUNK_SIZE={value!r}; it must be a positive number of bytes")
+        return DEFAULT_DOWNLOAD_CHUNK_SIZE
+    return chunk_size
+
+
+# the number of bytes read from the response and written to disk at a time while
+# downloading an archive; this can be tuned with the NBGITPULLER_DOWNLOAD_CHUNK_SIZE
+# environment variable
+DOWNLOAD_CHUNK_SIZE = get_download_chunk_size()
+
+# a download progress message is shown once at least this many more bytes have been written and
+# at least this many seconds have passed since the last one; each message is a round trip to the UI
+PROGRESS_INTERVAL_BYTES = 16 * BYTES_PER_MB
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+# gzipped tar archives at least this large are decompressed on every core with rapidgzip when it is installed
+PARALLEL_GUNZIP_THRESHOLD = 64 * BYTES_PER_MB
+# the number of threads used to extract the members of a zip archive
+EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+# archives at least this large are downloaded over DOWNLOAD_SEGMENTS connections at once when the
+# server accepts range requests
+SEGMENTED_DOWNLOAD_THRESHOLD = 32 * BYTES_PER_MB
+DOWNLOAD_SEGMENTS = 4
+# how many times a download that drops part way through is resumed before giving up
+DOWNLOAD_RESUME_ATTEMPTS = 3
+# the seconds to wait for a connection and then for each read of a response; a connection that stalls
+# without being closed raises a timeout, which is resumed like any other dropped connection
+DOWNLOAD_TIMEOUT = (10, 60)
+# the errors raised when the connection drops part way through a download; urllib3's errors come from
+# reading the body through response.raw in iter_response_body
+RESUMABLE_DOWNLOAD_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.HTTPError,
+)
+# archives of a known size are downloaded to RAM-backed /dev/shm when it has at least TMPFS_SIZE_FACTOR
+# times that size free; the NBGITPULLER_TMPDIR environment variable picks the directory instead
+TMPFS_DIR = "/dev/shm"
+TMPFS_SIZE_FACTOR = 2
+# top level entries of the unarchived files that are never the directory of the download
+IGNORED_TOP_LEVEL_NAMES = (".git", "__MACOSX")
+
+
+def create_session():
+    """
+    Creates a requests.Session whose connections are pooled and kept alive between downloads and
+    whose requests are retried when the server is briefly unavailable.
 
+    :return the configured session
+    :rtype requests.Session
+    """
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# shared by every download made through this module so repeated pulls from the same
+# host reuse an open connection instead of repeating the TCP and TLS handshakes
+_SESSION = create_session()
 
-def execute_cmd(cmd, **kwargs):
+
+def execute_cmd(cmd, stream_output=True, **kwargs):
     """
     Call given command, yielding output line by line
 
     :param arr cmd: the commands to be executed
+    :param bool stream_output: when False the standard output of the command is discarded instead of being
+        read through a pipe and yielded; its error output is only yielded if the command fails
     :param [*] kwargs: potential keyword args included with command
     """
     yield '$ {}\n'.format(' '.join(cmd))
+    if not stream_output:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, **kwargs)
+        if result.returncode != 0:
+            stderr = result.stderr.decode('utf8', errors='replace')
+            yield stderr
+            raise subprocess.CalledProcessError(result.returncode, cmd, stderr=stderr)
+        return
+
     kwargs['stdout'] = subprocess.PIPE
     kwargs['stderr'] = subprocess.STDOUT
 
@@ -28,25 +153,14 @@ def execute_cmd(cmd, **kwargs):
 
     # Capture output for logging.
     # Each line will be yielded as text.
-    # This should behave the same as .readline(), but splits on `\r` OR `\n`,
-    # not just `\n`.
-    buf = []
-
-    def flush():
-        line = b''.join(buf).decode('utf8', 'replace')
-        buf[:] = []
-        return line
-
-    c_last = ''
+    # newline='' splits on `\r`, `\n` or `\r\n` without translating them,
+    # reading the pipe a block at a time rather than a byte at a time.
+    output = io.TextIOWrapper(proc.stdout, encoding='utf8', errors='replace', newline='')
     try:
-        for c in iter(partial(proc.stdout.read, 1), b''):
-            if c_last == b'\r' and buf and c != b'\n':
-                yield flush()
-            buf.append(c)
-            if c == b'\n':
-                yield flush()
-            c_last = c
+        for line in output:
+            yield line
     finally:
+        output.close()
         ret = proc.wait()
         if ret != 0:
             raise subprocess.CalledProcessError(ret, cmd)
@@ -55,28 +169,57 @@ def execute_cmd(cmd, **kwargs):
 def initialize_local_repo(local_repo_path):
     """
     Sets up a local repo that acts like a remote; yields the
-    output from the git init
+    output from the git init. When pygit2 is installed the repo is
+    initialized in-process instead of running git.
 
     :param str local_repo_path: the local path where the local git repo is initialized
     """
     yield "Initializing repo ...\n"
     logging.info(f"Creating local_repo_path: {local_repo_path}")
     os.makedirs(local_repo_path, exist_ok=True)
+    if pygit2 is not None:
+        pygit2.init_repository(local_repo_path, bare=True, initial_head="main")
+        yield f"Initialized empty Git repository in {local_repo_path} with pygit2\n"
+        return
     for e in execute_cmd(["git", "init", "--bare", "--initial-branch=main"], cwd=local_repo_path):
         yield e
 
 
+def is_initialized_repo(local_repo_path):
+    """
+    Checks whether initialize_local_repo has finished setting up the repo; a directory left
+    behind by an interrupted git init has no HEAD.
+
+    :param str local_repo_path: the local path where the local git repo is initialized
+    :return whether the bare repo exists
+    :rtype bool
+    """
+    return os.path.isfile(os.path.join(local_repo_path, "HEAD"))
+
+
 def clone_local_origin_repo(origin_repo_path, temp_download_repo):
     """
     Cloned the local origin repo(origin_repo_path) to the folder, temp_download_repo.
     The folder, temp_download_repo, acts like the space where someone makes changes
     to master notebooks and then pushes the changes back to the local origin repo. In summary,
-    the folder, temp_download_repo, is where the compressed archive is downloaded,
-    unarchived, and then pushed to the local origin repo.
+    the folder, temp_download_repo, is where the compressed archive is unarchived
+    and then pushed to the local origin repo.
+
+    The clone is kept between pulls; if temp_download_repo is already a clone it is
+    brought up to date with the local origin repo instead of being cloned again.
 
     :param str origin_repo_path: the local path initialized as a git repo by git init
-    :param str temp_download_repo: folder where the compressed archive is downloaded and decompressed
+    :param str temp_download_repo: folder where the compressed archive is decompressed
     """
+    if os.path.isdir(os.path.join(temp_download_repo, ".git")):
+        try:
+            for e in update_local_origin_clone(temp_download_repo):
+                yield e
+            return
+        except subprocess.CalledProcessError:
+            # e.g. nothing was ever pushed to the local origin repo; start again from a fresh clone
+            logging.info(f"Could not update {temp_download_repo}; cloning it again")
+
     yield "Cloning repo ...\n"
     if os.path.exists(temp_download_repo):
         shutil.rmtree(temp_download_repo)
@@ -88,6 +231,22 @@ def clone_local_origin_repo(origin_repo_path, temp_download_repo):
         yield e
 
 
+def update_local_origin_clone(temp_download_repo):
+    """
+    Brings an existing clone of the local origin repo up to date and removes anything left in it
+    that is not committed, so it matches a fresh clone; only new objects are fetched.
+
+    :param str temp_download_repo: folder where the local origin repo was cloned
+    """
+    yield "Updating repo ...\n"
+    for e in execute_cmd(["git", "fetch", "origin"], cwd=temp_download_repo):
+        yield e
+    for e in execute_cmd(["git", "reset", "--hard", "origin/main"], stream_output=False, cwd=temp_download_repo):
+        yield e
+    for e in execute_cmd(["git", "clean", "-fdxq"], stream_output=False, cwd=temp_download_repo):
+        yield e
+
+
 def extract_file_extension(url):
     """
     The file extension(e.g. zip, tgz, etc.) is extracted from the url to facilitate de-compressing the file
@@ -102,40 +261,464 @@ def extract_file_extension(url):
     raise Exception(f"Could not determine compression type of: {url}")
 
 
-def execute_unarchive(ext, temp_download_file, temp_download_repo):
+def extract_archive(ext, fileobj, temp_download_repo):
     """
-    un-archives file using unzip or tar to the temp_download_repo
+    un-archives the archive read from fileobj to the temp_download_repo in-process. Tar archives are read
+    as a stream so fileobj may be a pipe; zip archives need a seekable file.
 
     :param str ext: extension used to determine type of compression
-    :param str temp_download_file: the file path to be unarchived
+    :param fileobj: the binary file object the archive is read from
     :param str temp_download_repo: where the file is unarchived to
+    :return the top level names in the archive, in archive order
+    :rtype list
     """
     if ext == 'zip':
-        cmd_arr = ['unzip', "-qo", temp_download_file, "-d", temp_download_repo]
+        with zipfile.ZipFile(fileobj) as zf:
+            extract_zip_members(zf, temp_download_repo)
+            return get_top_level_names(zf.namelist())
+    elif rapidgzip is not None and is_large_gzip_file(fileobj):
+        with rapidgzip.open(fileobj, parallelization=os.cpu_count()) as gz:
+            return extract_tar_stream(gz, 'r|', temp_download_repo)
     else:
-        cmd_arr = ['tar', 'xzf', temp_download_file, '-C', temp_download_repo]
-    for e in execute_cmd(cmd_arr, cwd=temp_download_repo):
-        yield e
+        return extract_tar_stream(fileobj, 'r|*', temp_download_repo)
+
+
+def get_top_level_names(member_names):
+    """
+    Finds the top level files and directories of an archive from the names of its members.
+
+    :param list member_names: the names of the members of the archive
+    :return the top level names, without duplicates or the IGNORED_TOP_LEVEL_NAMES, in archive order
+    :rtype list
+    """
+    top_level_names = {}
+    for member_name in member_names:
+        top_level_name = posixpath.normpath(member_name).split("/")[0]
+        if top_level_name not in ("", ".", "..") and top_level_name not in IGNORED_TOP_LEVEL_NAMES:
+            top_level_names[top_level_name] = None
+    return list(top_level_names)
+
+
+def extract_zip_members(zf, temp_download_repo):
+    """
+    Extracts the members of the zip archive on a pool of threads; zlib releases the GIL while it
+    decompresses so the members are inflated in parallel.
+
+    :param zipfile.ZipFile zf: the open zip archive
+    :param str temp_download_repo: where the file is unarchived to
+    """
+    def extract(info):
+        try:
+            path = zf.extract(info, temp_download_repo)
+        except FileExistsError:
+            # another thread created the same parent directory between zipfile's check and its makedirs
+            path = zf.extract(info, temp_download_repo)
+        except PermissionError as ex:
+            # a read-only file left in the kept clone by an earlier pull can not be opened for writing
+            if not ex.filename or not os.path.isfile(ex.filename):
+                raise
+            os.unlink(ex.filename)
+            path = zf.extract(info, temp_download_repo)
+        # zipfile drops the executable bit unzip would restore(e.g. scripts); it is the only mode bit git
+        # records, so the other bits are left alone and the file stays writable for the next pull
+        executable_bits = (info.external_attr >> 16) & 0o111
+        if executable_bits and not info.is_dir():
+            os.chmod(path, os.stat(path).st_mode | executable_bits)
+
+    with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+        # list() re-raises the first error from the workers
+        list(executor.map(extract, zf.infolist()))
+
+
+def extract_tar_stream(fileobj, mode, temp_download_repo):
+    """
+    Extracts a tar archive read as a stream from fileobj.
+
+    :param fileobj: the binary file object the archive is read from
+    :param str mode: the tarfile stream mode(e.g. r|* or r| for already decompressed input)
+    :param str temp_download_repo: where the file is unarchived to
+    :return the top level names in the archive, in archive order
+    :rtype list
+    """
+    with tarfile.open(fileobj=fileobj, mode=mode) as tf:
+        if hasattr(tarfile, 'data_filter'):
+            tf.extractall(temp_download_repo, filter='data')
+        else:
+            tf.extractall(temp_download_repo, members=get_safe_tar_members(tf, temp_download_repo))
+        # extractall has already read every member so this does not read the stream again
+        return get_top_level_names(tf.getnames())
+
+
+def get_safe_tar_members(tf, temp_download_repo):
+    """
+    Yields the members of the tar archive as they are read, refusing any that would be written outside the
+    temp_download_repo: absolute paths, paths through .., links pointing outside it and device files. This
+    stands in for tarfile's data filter on Pythons that do not have it.
+
+    :param tarfile.TarFile tf: the open tar archive
+    :param str temp_download_repo: where the file is unarchived to
+    """
+    dest = os.path.realpath(temp_download_repo)
+
+    def is_inside_dest(path):
+        return os.path.commonpath([dest, path]) == dest
+
+    for member in tf:
+        # realpath also resolves links already extracted, so nothing is written through them
+        path = os.path.realpath(os.path.join(dest, member.name))
+        if os.path.isabs(member.name) or not is_inside_dest(path):
+            raise tarfile.TarError(f"{member.name} would be extracted outside {temp_download_repo}")
+        if member.issym():
+            target = os.path.realpath(os.path.join(os.path.dirname(path), member.linkname))
+        elif member.islnk():
+            target = os.path.realpath(os.path.join(dest, member.linkname))
+        else:
+            target = path
+        if os.path.isabs(member.linkname) or not is_inside_dest(target):
+            raise tarfile.TarError(f"{member.name} links to {member.linkname} outside {temp_download_repo}")
+        if member.isdev():
+            raise tarfile.TarError(f"{member.name} is a device file")
+        yield member
+
+
+def is_large_gzip_file(fileobj):
+    """
+    Checks whether fileobj is a seekable gzip file of at least PARALLEL_GUNZIP_THRESHOLD bytes; only
+    these are worth handing to rapidgzip, which needs to seek.
+
+    :param fileobj: the binary file object the archive is read from
+    :return whether the file should be decompressed in parallel
+    :rtype bool
+    """
+    if not fileobj.seekable():
+        return False
+    start = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END) - start
+    fileobj.seek(start)
+    magic = fileobj.read(2)
+    fileobj.seek(start)
+    return size >= PARALLEL_GUNZIP_THRESHOLD and magic == b'\x1f\x8b'
+
+
+def execute_unarchive(ext, temp_download_file, temp_download_repo):
+    """
+    un-archives file using zipfile or tarfile to the temp_download_repo
+
+    :param str ext: extension used to determine type of compression
+    :param str temp_download_file: the file path to be unarchived
+    :param str temp_download_repo: where the file is unarchived to
+    :return the top level names in the archive
+    :rtype list
+    """
+    yield "Unarchiving archive ...\n"
+    with open(temp_download_file, 'rb') as f:
+        return extract_archive(ext, f, temp_download_repo)
 
 
-def download_archive(source_url=None, temp_download_file=None):
+def stream_download_and_unarchive(download_func, download_args, temp_download_repo):
     """
-    This requests the file from the source_url given and saves it to the disk
+    Downloads a tar archive into a pipe that a background thread unarchives to the temp_download_repo
+    as it arrives; the archive itself is never written to disk. The download function is handed the
+    write end of the pipe in place of the path to the temp_download_file.
+
+    :param func download_func: the function that downloads the archive
+    :param dict download_args: the parameters passed to download_func
+    :param str temp_download_repo: where the file is unarchived to
+    :return the top level names in the archive
+    :rtype list
+    """
+    yield "Downloading and unarchiving archive ...\n"
+    read_fd, write_fd = os.pipe()
+    errors = []
+    top_level_names = []
+
+    def extract():
+        try:
+            with open(read_fd, 'rb') as reader:
+                top_level_names.extend(extract_archive("tgz", reader, temp_download_repo))
+                # tar stops at its end-of-archive marker; drain any padding so the download never blocks
+                while reader.read(DOWNLOAD_CHUNK_SIZE):
+                    pass
+        except Exception as ex:
+            errors.append(ex)
+
+    extractor = threading.Thread(target=extract, daemon=True)
+    extractor.start()
+    try:
+        with open(write_fd, 'wb') as writer:
+            for e in download_func(**dict(download_args, temp_download_file=writer)):
+                yield e
+    except BrokenPipeError:
+        # the extractor stopped reading because it failed; its error explains why
+        extractor.join()
+        if errors:
+            raise errors[0]
+        raise
+    finally:
+        extractor.join()
+    if errors:
+        raise errors[0]
+    return top_level_names
+
+
+def open_download_target(temp_download_file):
+    """
+    Opens the place a download is saved to. This is usually the path to the temp_download_file but
+    may already be an open binary file object(e.g. the pipe used by stream_download_and_unarchive),
+    which is then left for the caller to close. An existing temp_download_file is a partial download
+    so it is opened positioned at its end for the download to resume; otherwise a new file is created.
+
+    :param temp_download_file: the path or binary file object to save the download to
+    :return a context manager giving the binary file object to write to
+    """
+    if hasattr(temp_download_file, "write"):
+        return nullcontext(temp_download_file)
+    if os.path.exists(temp_download_file):
+        f = open(temp_download_file, 'r+b')
+        f.seek(0, os.SEEK_END)
+        return f
+    return open(temp_download_file, 'wb')
+
+
+def preallocate_file(f, size):
+    """
+    Reserves the disk space for a file of size bytes in a single call, where the platform and file system
+    support it, so the blocks are not allocated piecemeal as the download is written.
+
+    :param f: the binary file object being downloaded to
+    :param int size: the size the file will be once the download completes
+    """
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        logging.info(f"Could not preallocate {size} bytes for the download")
+
+
+class DownloadProgress:
+    """
+    Decides when the next download progress message is due; see PROGRESS_INTERVAL_BYTES and
+    PROGRESS_INTERVAL_SECONDS.
+    """
+    def __init__(self, bytes_written=0):
+        """
+        :param int bytes_written: the number of bytes already written when the download starts
+        """
+        self.reported_bytes = bytes_written
+        self.reported_time = time.monotonic()
+
+    def message(self, bytes_written):
+        """
+        :param int bytes_written: the number of bytes written so far
+        :return the progress message if one is due or None
+        :rtype str
+        """
+        if bytes_written - self.reported_bytes < PROGRESS_INTERVAL_BYTES:
+            return None
+        now = time.monotonic()
+        if now - self.reported_time < PROGRESS_INTERVAL_SECONDS:
+            return None
+        self.reported_bytes = bytes_written
+        self.reported_time = now
+        return f"Downloading Progress ... {bytes_written // BYTES_PER_MB}MB\n"
+
+
+def iter_response_body(response):
+    """
+    Yields the body of a streamed response DOWNLOAD_CHUNK_SIZE bytes at a time, read straight from urllib3 rather
+    than through iter_content. A body sent without a content-encoding is passed through as it arrives; encoded
+    bodies are decoded by urllib3. Reading through urllib3 lets it release the connection back to the pool once
+    the body is read, and raise an error for a body cut short by a closed connection.
+
+    :param response: the streamed response of the download request
+    :type response requests.Response
+    """
+    response.raw.decode_content = bool(response.headers.get("content-encoding"))
+    for chunk in iter(partial(response.raw.read, DOWNLOAD_CHUNK_SIZE), b''):
+        yield chunk
+
+
+def save_response_content(open_response, temp_download_file, response=None):
+    """
+    Saves the body of the download to temp_download_file. The body is read with iter_response_body rather
+    than through iter_content and progress messages are yielded as DownloadProgress decides they are due.
+    If the connection drops part way through, the rest of the file is requested
+    with a Range header, up to DOWNLOAD_RESUME_ATTEMPTS times; a partially downloaded temp_download_file
+    is resumed the same way.
+
+    :param func open_response: called with a headers keyword argument to request the file; it returns a
+        streamed requests.Response
+    :param temp_download_file: the path(or binary file object) to save the requested file to
+    :param response: [OPTIONAL] an already opened response for the whole file, used for the first attempt
+    :type response requests.Response
+    """
+    with open_download_target(temp_download_file) as f:
+        # a file opened here for appending can be restarted from scratch; a file object passed in can not
+        can_restart = f is not temp_download_file
+        bytes_written = f.tell() if can_restart else 0
+        if bytes_written and response is not None:
+            response.close()
+            response = None
+        attempts = 0
+        # a request that fails before any response arrives(e.g. a timeout) is simply made again
+        resumable = True
+        try:
+            while True:
+                try:
+                    if response is None:
+                        response = open_response(headers={"Range": f"bytes={bytes_written}-"} if bytes_written else {})
+                    with response:
+                        if bytes_written and response.status_code == 416:
+                            if response.headers.get("content-range") == f"bytes */{bytes_written}":
+                                break  # the partial file was already complete
+                            if not can_restart:
+                                raise ValueError("The server could not resume the download")
+                            # the partial file does not match the file on the server; download all of it again
+                            f.seek(0)
+                            f.truncate()
+                            bytes_written = 0
+                            response = None
+                            continue
+                        response.raise_for_status()
+                        if bytes_written and response.status_code != 206:
+                            if not can_restart:
+                                raise ValueError("The server does not support resuming the download")
+                            f.seek(0)
+                            f.truncate()
+                            bytes_written = 0
+                        # byte ranges count encoded bytes, so a decoded body can not be resumed
+                        resumable = not response.headers.get("content-encoding")
+                        content_length = response.headers.get("content-length")
+                        if can_restart and resumable and content_length and content_length.isdigit():
+                            preallocate_file(f, bytes_written + int(content_length))
+                        progress = DownloadProgress(bytes_written)
+                        for chunk in iter_response_body(response):
+                            f.write(chunk)
+                            bytes_written += len(chunk)
+                            progress_msg = progress.message(bytes_written)
+                            if progress_msg:
+                                yield progress_msg
+                    break
+                except RESUMABLE_DOWNLOAD_ERRORS:
+                    attempts += 1
+                    if not resumable or attempts > DOWNLOAD_RESUME_ATTEMPTS:
+                        raise
+                    yield f"Download interrupted; resuming at {bytes_written // BYTES_PER_MB}MB ...\n"
+                    response = None
+        finally:
+            if can_restart:
+                # drop any preallocated space the body did not fill, also when the download failed, so a
+                # later attempt resumes from the last byte actually written
+                f.truncate(bytes_written)
+
+
+def probe_download(source_url):
+    """
+    Asks the server, with a single HEAD request, where the archive is after redirects, how large it is and
+    whether byte ranges of it can be requested; the answer decides whether the archive fits in /dev/shm,
+    whether it is streamed and whether it is downloaded in segments.
+
+    :param str source_url: the url to source files to be downloaded
+    :return the url after redirects, the size of the archive in bytes(None if the server does not say) and
+        whether it accepts byte ranges; a failed request gives (source_url, None, False)
+    :rtype tuple
+    """
+    try:
+        with _SESSION.head(source_url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            # the size and byte ranges of a content-encoded archive do not describe the archive itself
+            if r.status_code != 200 or r.headers.get("content-encoding"):
+                return source_url, None, False
+            content_length = r.headers.get("content-length")
+            size = int(content_length) if content_length and content_length.isdigit() else None
+            return r.url, size, r.headers.get("accept-ranges") == "bytes"
+    except requests.RequestException:
+        return source_url, None, False
+
+
+def download_archive_in_segments(source_url, temp_download_file, size):
+    """
+    Downloads the archive as DOWNLOAD_SEGMENTS byte ranges requested in parallel; each range is written at its
+    own offset in the file, which is allocated at its full size up front. A range whose connection drops part
+    way through is resumed, up to DOWNLOAD_RESUME_ATTEMPTS times.
 
     :param str source_url: the url to source files to be downloaded
     :param str temp_download_file: the path to save the requested file to
+    :param int size: the size of the archive in bytes
+    """
+    segment_size = -(-size // DOWNLOAD_SEGMENTS)
+    ranges = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+    bytes_written = [0] * len(ranges)
+    stop = threading.Event()
+
+    with open(temp_download_file, 'wb') as f:
+        fd = f.fileno()
+        preallocate_file(f, size)
+
+        def download_segment(index):
+            start, end = ranges[index]
+            offset = start
+            attempts = 0
+            while True:
+                try:
+                    # a segment that dropped part way through is resumed from the last byte written
+                    with _SESSION.get(source_url, headers={"Range": f"bytes={offset}-{end}"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                        if r.status_code != 206:
+                            raise ValueError(f"Range request for {source_url} returned status {r.status_code}")
+                        for chunk in iter_response_body(r):
+                            if stop.is_set():
+                                return
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            bytes_written[index] = offset - start
+                except RESUMABLE_DOWNLOAD_ERRORS:
+                    attempts += 1
+                    if stop.is_set() or attempts > DOWNLOAD_RESUME_ATTEMPTS:
+                        raise
+                    continue
+                if offset != end + 1:
+                    raise ValueError(f"Range {start}-{end} of {source_url} ended after {offset - start} bytes")
+                return
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            pending = [executor.submit(download_segment, index) for index in range(len(ranges))]
+            progress = DownloadProgress()
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=0.5, return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        future.result()
+                    progress_msg = progress.message(sum(bytes_written))
+                    if progress_msg:
+                        yield progress_msg
+            finally:
+                stop.set()
+
+
+def download_archive(source_url=None, temp_download_file=None, download_probe=None):
+    """
+    This requests the file from the source_url given and saves it to the disk. Archives of at least
+    SEGMENTED_DOWNLOAD_THRESHOLD bytes on servers that accept range requests are downloaded in segments
+    over several connections.
+
+    :param str source_url: the url to source files to be downloaded
+    :param temp_download_file: the path(or binary file object) to save the requested file to
+    :param tuple download_probe: [OPTIONAL] what probe_download already found out about the source_url; it
+        is asked of the server when it is needed and not given
     """
     yield "Downloading archive ...\n"
-    with requests.get(source_url, stream=True) as r:
-        with open(temp_download_file, 'ab') as f:
-            count_chunks = 1
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    count_chunks += 1
-                    if count_chunks % 1000 == 0:
-                        display = count_chunks / 1000
-                        yield f"Downloading Progress ... {display}MB\n"
-                    f.write(chunk)
+    if not hasattr(temp_download_file, "write"):
+        if download_probe is None:
+            download_probe = probe_download(source_url)
+        url, size, accepts_ranges = download_probe
+        if accepts_ranges and size is not None and size >= SEGMENTED_DOWNLOAD_THRESHOLD:
+            for progress_msg in download_archive_in_segments(url, temp_download_file, size):
+                yield progress_msg
+            yield "Archive Downloaded....\n"
+            return
+
+    for progress_msg in save_response_content(partial(_SESSION.get, source_url, stream=True, timeout=DOWNLOAD_TIMEOUT), temp_download_file):
+        yield progress_msg
 
     yield "Archive Downloaded....\n"
 
@@ -146,7 +729,7 @@ def push_to_local_origin(temp_download_repo):
 
     :param str temp_download_repo: the current working directly of folder where the archive had been downloaded and unarchived
     """
-    for e in execute_cmd(["git", "add", "."], cwd=temp_download_repo):
+    for e in execute_cmd(["git", "add", "."], stream_output=False, cwd=temp_download_repo):
         yield e
     commit_cmd = [
         "git",
@@ -154,12 +737,79 @@ def push_to_local_origin(temp_download_repo):
         "-c", "user.name=nbgitpuller",
         "commit", "-q", "-m", "test", "--allow-empty"
     ]
-    for process_message in execute_cmd(commit_cmd, cwd=temp_download_repo):
+    for process_message in execute_cmd(commit_cmd, stream_output=False, cwd=temp_download_repo):
         yield process_message
     for process_message in execute_cmd(["git", "push", "origin", "main"], cwd=temp_download_repo):
         yield process_message
 
 
+def get_temp_download_parent(download_size=None):
+    """
+    Chooses the directory the temporary download space is created in: the NBGITPULLER_TMPDIR environment
+    variable if it is set, otherwise /dev/shm when the size of the archive is known and /dev/shm is writable
+    with TMPFS_SIZE_FACTOR times that size free so the archive never touches the disk, otherwise None to use
+    the system default. /dev/shm is held in memory, so an archive of unknown size is never put there.
+
+    :param int download_size: [OPTIONAL] the size of the archive in bytes
+    :return the directory to create the temporary download space in or None
+    :rtype str
+    """
+    if os.environ.get("NBGITPULLER_TMPDIR"):
+        return os.environ["NBGITPULLER_TMPDIR"]
+    if not download_size or not os.path.isdir(TMPFS_DIR) or not os.access(TMPFS_DIR, os.W_OK):
+        return None
+    if shutil.disk_usage(TMPFS_DIR).free >= TMPFS_SIZE_FACTOR * download_size:
+        return TMPFS_DIR
+    return None
+
+
+def get_source_path_part(git_url):
+    """
+    Names the directories cached for a source url; a fixed length digest of the url keeps the path short
+    however long the url is.
+
+    :param str git_url: the url of the archive
+    :return the name of the directories for the url
+    :rtype str
+    """
+    return hashlib.blake2b(git_url.encode(), digest_size=16).hexdigest()
+
+
+def acquire_file_lock(lock_file):
+    """
+    Takes an exclusive lock on the open lock_file, which is released when the file is closed. If another
+    pull holds the lock a message is yielded before waiting for it.
+
+    :param lock_file: the open lock file
+    """
+    if fcntl is None:
+        return
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        yield "Waiting for another pull of this archive to finish ...\n"
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+
+def get_local_origin_repo(git_puller_ref):
+    """
+    Gives the path to the local origin repo that the archive at git_puller_ref.git_url is pushed to. A local origin
+    repo made before they were named by get_source_path_part keeps being used: the users' clones fetch from it, so
+    pushing to a new one would silently stop their updates.
+
+    :param git_puller_ref: the reference to nbgitpuller's GitPuller class containing state information from the request
+    :type git_puller_ref nbgitpuller.GitPuller
+    :return the local path of the local origin repo
+    :rtype str
+    """
+    origin_parent = f"{git_puller_ref.repo_parent_dir}{CACHED_ORIGIN_NON_GIT_REPO}{git_puller_ref.content_provider}/"
+    local_origin_repo = f"{origin_parent}{get_source_path_part(git_puller_ref.git_url)}/"
+    legacy_local_origin_repo = f"{origin_parent}{git_puller_ref.git_url.translate(str.maketrans('', '', string.punctuation))}/"
+    if not os.path.isdir(local_origin_repo) and is_initialized_repo(legacy_local_origin_repo):
+        return legacy_local_origin_repo
+    return local_origin_repo
+
+
 class HandleFilesHelper:
     """
     This class is needed to handle the use of dir_names inside the async generator as well as in the return object for
@@ -180,15 +830,23 @@ class HandleFilesHelper:
                 - extension (e.g. zip, tar) [OPTIONAL] this may or may not be included. If the repo name contains
                     name of archive (e.g. example.zip) then this function can determine the extension for you; if not it
                     needs to be provided.
+                - stream_download [OPTIONAL] whether the download function can write to a pipe in place of the
+                    temp_download_file; tar archives are then unarchived while they are downloaded. This defaults
+                    to True for the standard download function and False otherwise; when rapidgzip is installed
+                    archives of at least PARALLEL_GUNZIP_THRESHOLD bytes are not streamed.
+                - download_size [OPTIONAL] the size of the archive in bytes if the download function knows it; it
+                    is asked of the server for the standard download function.
         :type git_puller_ref nbgitpuller.GitPuller
         """
         self.dir_names = None
         self.source_url = git_puller_ref.git_url
         self.content_provider = git_puller_ref.content_provider
         self.repo_parent_dir = git_puller_ref.repo_parent_dir
-        source_origin_path_part = git_puller_ref.git_url.translate(str.maketrans('', '', string.punctuation))
-        self.local_origin_repo = f"{self.repo_parent_dir}{CACHED_ORIGIN_NON_GIT_REPO}{self.content_provider}/{source_origin_path_part}/"
-        self.temp_download_dir = tempfile.TemporaryDirectory()
+        self.local_origin_repo = get_local_origin_repo(git_puller_ref)
+        source_origin_path_part = get_source_path_part(git_puller_ref.git_url)
+        self.temp_download_repo = f"{self.repo_parent_dir}{CACHED_WORKTREE_NON_GIT_REPO}{self.content_provider}/{source_origin_path_part}/"
+        # held while the clone is in use so concurrent pulls of the same archive take turns
+        self.temp_download_repo_lock = f"{self.temp_download_repo.rstrip('/')}.lock"
 
         # you can optionally pass the extension of your archive(e.g. zip) if it is not identifiable from the URL file name
         # otherwise the extract_file_extension function will pull it off the repo name
@@ -196,57 +854,85 @@ class HandleFilesHelper:
             self.ext = extract_file_extension(git_puller_ref.git_url)
         else:
             self.ext = git_puller_ref.other_kw_args['extension']
+
+        # you can pass your own download function as well as download function parameters
+        # if they are different from the standard download function and parameters.
+        self.download_func = git_puller_ref.other_kw_args.get("download_func", download_archive)
+
+        # zip archives keep their index at the end of the file so they are always downloaded to disk first
+        default_stream_download = "download_func" not in git_puller_ref.other_kw_args
+        stream_download = self.ext != "zip" and git_puller_ref.other_kw_args.get("stream_download", default_stream_download)
+
+        # the size of the archive decides whether it fits in /dev/shm and whether rapidgzip is worth using
+        self.download_size = git_puller_ref.other_kw_args.get("download_size")
+        download_probe = None
+        if self.download_size is None and self.download_func is download_archive and (not stream_download or rapidgzip is not None):
+            download_probe = probe_download(self.source_url)
+            self.download_size = download_probe[1]
+
+        # with rapidgzip installed large tar archives are downloaded to disk first so they can be decompressed on every core
+        self.stream_download = stream_download and not (
+            rapidgzip is not None and self.download_size is not None and self.download_size >= PARALLEL_GUNZIP_THRESHOLD)
+        self.temp_download_dir = tempfile.TemporaryDirectory(dir=get_temp_download_parent(self.download_size))
         self.temp_download_file = f"{self.temp_download_dir.name}/download.{self.ext}"
-        self.download_func = download_archive
         self.download_args = {
             "source_url": self.source_url,
             "temp_download_file": self.temp_download_file
         }
+        if download_probe is not None:
+            # the standard download function reuses the probe rather than asking the server again
+            self.download_args["download_probe"] = download_probe
 
-        # you can pass your own download function as well as download function parameters
-        # if they are different from the standard download function and parameters. Notice I add
-        # the temp_download_file to the parameters
-        if "download_func" in git_puller_ref.other_kw_args:
-            self.download_func = git_puller_ref.other_kw_args["download_func"]
+        # Notice I add the temp_download_file to the download function parameters
         if "download_func_params" in git_puller_ref.other_kw_args:
             git_puller_ref.other_kw_args["download_func_params"]["temp_download_file"] = self.temp_download_file
             self.download_args = git_puller_ref.other_kw_args["download_func_params"]
 
     def handle_download_and_extraction(self):
         """
-        This does all the heavy lifting in the order needed to set up a temporary local repo cloned from
-        the local origin repo that will the downloaded and decompressed files. When this process completes,
+        This does all the heavy lifting in the order needed to set up a local repo cloned from
+        the local origin repo that will the downloaded and decompressed files; the clone is kept between pulls and
+        only the downloaded archive goes in the temporary download space. When this process completes,
         self.dir_names contains the name of directory where the source files are stared in the local origin repo as well as
         the local path to the local origin repo. These directories are passed back to nbgitpuller which then pulls(in a git way)
         these files as if it was pulling for a remote git repository.  All the messages that are "yielded" here are being shown in the
-        UI to help the user understand the progress being made and any errors that might occur.
+        UI to help the user understand the progress being made and any errors that might occur. The clone is locked
+        throughout so a concurrent pull of the same archive waits for this one to finish.
         """
 
         try:
-            if not os.path.exists(self.local_origin_repo):
-                for progress_msg in initialize_local_repo(self.local_origin_repo):
+            os.makedirs(os.path.dirname(self.temp_download_repo_lock), exist_ok=True)
+            with open(self.temp_download_repo_lock, "a") as lock_file:
+                for progress_msg in acquire_file_lock(lock_file):
                     yield progress_msg
 
-            for progress_msg in clone_local_origin_repo(self.local_origin_repo, self.temp_download_dir.name):
-                yield progress_msg
+                if not is_initialized_repo(self.local_origin_repo):
+                    for progress_msg in initialize_local_repo(self.local_origin_repo):
+                        yield progress_msg
 
-            for progress_msg in self.download_func(**self.download_args):
-                yield progress_msg
+                for progress_msg in clone_local_origin_repo(self.local_origin_repo, self.temp_download_repo):
+                    yield progress_msg
 
-            for progress_msg in execute_unarchive(self.ext, self.temp_download_file, self.temp_download_dir.name):
-                yield progress_msg
+                if self.stream_download:
+                    unzipped_names = yield from stream_download_and_unarchive(self.download_func, self.download_args, self.temp_download_repo)
+                else:
+                    for progress_msg in self.download_func(**self.download_args):
+                        yield progress_msg
 
-            os.remove(self.temp_download_file)
-            for progress_msg in push_to_local_origin(self.temp_download_dir.name):
-                yield progress_msg
+                    unzipped_names = yield from execute_unarchive(self.ext, self.temp_download_file, self.temp_download_repo)
+
+                    os.remove(self.temp_download_file)
+                for progress_msg in push_to_local_origin(self.temp_download_repo):
+                    yield progress_msg
 
-            unzipped_dirs = os.listdir(self.temp_download_dir.name)
-            # name of the extracted directory
-            self.dir_names = list(filter(lambda dir_name: ".git" not in dir_name and "__MACOSX" not in dir_name, unzipped_dirs))
+                if not unzipped_names:
+                    unzipped_names = [entry.name for entry in os.scandir(self.temp_download_repo) if entry.name not in IGNORED_TOP_LEVEL_NAMES]
+                # name of the extracted directory; directories come before any loose files at the top of the archive
+                self.dir_names = sorted(unzipped_names, key=lambda name: not os.path.isdir(os.path.join(self.temp_download_repo, name)))
 
-            yield "\n\n"
-            yield "Process Complete: Archive is finished importing into hub\n"
-            yield f"The directory of your download is: {self.dir_names[0]}\n"
+                yield "\n\n"
+                yield "Process Complete: Archive is finished importing into hub\n"
+                yield f"The directory of your download is: {self.dir_names[0]}\n"
 
         except Exception as ex:
             logging.exception(ex)
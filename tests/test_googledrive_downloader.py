@@ -0,0 +1,157 @@
+import io
+import os
+import pytest
+import requests
+import responses
+import shutil
+from responses import matchers
+
+pytest.importorskip("nbgitpuller.plugin_hook_specs")
+import nbgitpuller_downloader_googledrive.googledrive_downloader as gd  # noqa: E402
+import nbgitpuller_downloader_plugins_util.plugin_helper as ph  # noqa: E402
+
+test_files_dir = os.getcwd() + "/tests/test_files"
+archive_base = "/tmp/test_drive_files"
+repo_parent_dir = "/tmp/fake_drive/"
+temp_archive_download = "/tmp/drive_archive_download/"
+file_id = "1Ab2Cd3Ef"
+drive_url = f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
+drive_params = matchers.query_param_matcher({"export": "download", "id": file_id})
+
+
+class GitPullerRef:
+    def __init__(self, git_url):
+        self.git_url = git_url
+        self.content_provider = "googledrive"
+        self.repo_parent_dir = repo_parent_dir
+        self.other_kw_args = {}
+
+
+@pytest.fixture
+async def test_configuration():
+    shutil.make_archive(archive_base, 'gztar', test_files_dir)
+    os.makedirs(repo_parent_dir, exist_ok=True)
+    os.makedirs(temp_archive_download, exist_ok=True)
+    with open(archive_base + ".tar.gz", "rb") as f:
+        yield f.read()
+    os.remove(archive_base + ".tar.gz")
+    shutil.rmtree(repo_parent_dir)
+    shutil.rmtree(temp_archive_download)
+
+
+def return_value(generator):
+    try:
+        while True:
+            next(generator)
+    except StopIteration as stop:
+        return stop.value
+
+
+def drive_calls():
+    return [call for call in responses.calls if call.request.url.startswith(gd.DOWNLOAD_URL.split("?")[0])]
+
+
+class DroppedBody(io.RawIOBase):
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        raise ph.urllib3.exceptions.ProtocolError("Connection reset by peer")
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_prepare_downloads_drive_file_once(test_configuration):
+    responses.add(responses.GET, "https://docs.google.com/uc", body=test_configuration, match=[drive_params],
+                  headers={"Content-Disposition": 'attachment; filename="archive.tar.gz"'})
+    output_info = return_value(gd.prepare_non_git_source_local_origin(GitPullerRef(drive_url)))
+    assert len(drive_calls()) == 1
+    assert output_info["source_dir_name"] == "test.txt"
+    assert os.path.isfile(output_info["local_origin_repo_path"] + "HEAD")
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_for_google_requests_again_when_kept_response_drops(test_configuration):
+    responses.add(responses.GET, "https://docs.google.com/uc", body=test_configuration, match=[drive_params])
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = DroppedBody()
+    temp_download_file = temp_archive_download + "download.gz"
+    yield_str = ""
+    for line in gd.download_archive_for_google(drive_url, temp_download_file, response):
+        yield_str += line
+    assert "Download interrupted" in yield_str
+    assert len(drive_calls()) == 1
+    with open(temp_download_file, "rb") as f:
+        assert f.read() == test_configuration
+
+
+@pytest.mark.parametrize("content_disposition,ext", [
+    ('attachment; filename="archive.tar.gz"', "gz"),
+    ('attachment; filename*="UTF-8\'\'notebooks.zip"', "zip"),
+    ('attachment; filename="archive"; filename*=UTF-8\'\'archive.tgz', "tgz"),
+])
+def test_determine_file_extension_from_response(content_disposition, ext):
+    response = requests.Response()
+    response.headers["Content-Disposition"] = content_disposition
+    assert gd.determine_file_extension_from_response(response) == ext
+
+
+@pytest.mark.parametrize("content_disposition", ['attachment; filename="archive"', None])
+def test_determine_file_extension_from_response_without_extension(content_disposition):
+    response = requests.Response()
+    if content_disposition:
+        response.headers["Content-Disposition"] = content_disposition
+    with pytest.raises(Exception, match="Could not determine compression type"):
+        gd.determine_file_extension_from_response(response)
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_prepare_skips_unchanged_drive_file(test_configuration):
+    def conditional_get(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return 304, {}, b''
+        return 200, {"Content-Disposition": 'attachment; filename="archive.tar.gz"', "ETag": '"v1"'}, test_configuration
+
+    responses.add_callback(responses.GET, "https://docs.google.com/uc", callback=conditional_get, match=[drive_params])
+    first = return_value(gd.prepare_non_git_source_local_origin(GitPullerRef(drive_url)))
+    metadata = gd.load_download_metadata(repo_parent_dir + gd.DOWNLOAD_METADATA_CACHE)
+    assert metadata == {ph.get_source_path_part(drive_url): {"etag": '"v1"', "last_modified": None, "source_dir_name": "test.txt"}}
+
+    yield_str = ""
+    generator = gd.prepare_non_git_source_local_origin(GitPullerRef(drive_url))
+    try:
+        while True:
+            yield_str += next(generator)
+    except StopIteration as stop:
+        second = stop.value
+    assert "Archive has not changed" in yield_str
+    assert second == first
+    assert drive_calls()[-1].request.headers["If-None-Match"] == '"v1"'
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_prepare_ignores_metadata_without_source_dir_name(test_configuration):
+    responses.add(responses.GET, "https://docs.google.com/uc", body=test_configuration, match=[drive_params],
+                  headers={"Content-Disposition": 'attachment; filename="archive.tar.gz"'})
+    for line in ph.initialize_local_repo(ph.get_local_origin_repo(GitPullerRef(drive_url))):
+        pass
+    gd.save_download_metadata(repo_parent_dir + gd.DOWNLOAD_METADATA_CACHE, ph.get_source_path_part(drive_url), {"etag": '"v1"'})
+
+    output_info = return_value(gd.prepare_non_git_source_local_origin(GitPullerRef(drive_url)))
+    assert "If-None-Match" not in drive_calls()[-1].request.headers
+    assert output_info["source_dir_name"] == "test.txt"
+
+
+@responses.activate
+def test_get_response_from_drive_confirms_large_download(test_configuration):
+    responses.add(responses.GET, "https://docs.google.com/uc", body=b"<html>virus scan warning</html>", match=[drive_params],
+                  headers={"Set-Cookie": "download_warning_123=abc; Path=/"})
+    responses.add(responses.GET, "https://docs.google.com/uc", body=test_configuration,
+                  match=[matchers.query_param_matcher({"export": "download", "id": file_id, "confirm": "abc"})])
+    with gd.get_response_from_drive(gd.DOWNLOAD_URL, file_id) as response:
+        assert response.content == test_configuration
+    assert len(drive_calls()) == 2
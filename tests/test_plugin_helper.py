@@ -1,7 +1,10 @@
+import gzip
+import http.server
 import os
 import pytest
 import responses
 import shutil
+import threading
 import nbgitpuller_downloader_plugins_util.plugin_helper as ph
 
 test_files_dir = os.getcwd() + "/tests/test_files"
@@ -35,6 +38,45 @@ async def test_configuration():
     shutil.rmtree(temp_archive_download)
 
 
+def return_value(generator):
+    try:
+        while True:
+            next(generator)
+    except StopIteration as stop:
+        return stop.value
+
+
+def test_execute_cmd_splits_lines():
+    lines = list(ph.execute_cmd(["printf", "a\\rb\\nc\\r\\nd"]))
+    assert lines == ["$ printf a\\rb\\nc\\r\\nd\n", "a\r", "b\n", "c\r\n", "d"]
+
+
+def test_execute_cmd_without_streaming_output():
+    lines = list(ph.execute_cmd(["echo", "hidden"], stream_output=False))
+    assert lines == ["$ echo hidden\n"]
+    lines = []
+    with pytest.raises(ph.subprocess.CalledProcessError) as error:
+        for line in ph.execute_cmd(["sh", "-c", "echo hidden; echo failed >&2; exit 1"], stream_output=False):
+            lines.append(line)
+    assert lines[1:] == ["failed\n"]
+    assert error.value.stderr == "failed\n"
+
+
+@pytest.mark.parametrize("value,chunk_size", [
+    (None, ph.DEFAULT_DOWNLOAD_CHUNK_SIZE),
+    ("65536", 65536),
+    ("64k", ph.DEFAULT_DOWNLOAD_CHUNK_SIZE),
+    ("0", ph.DEFAULT_DOWNLOAD_CHUNK_SIZE),
+    ("-1", ph.DEFAULT_DOWNLOAD_CHUNK_SIZE),
+])
+def test_get_download_chunk_size(monkeypatch, value, chunk_size):
+    if value is None:
+        monkeypatch.delenv("NBGITPULLER_DOWNLOAD_CHUNK_SIZE", raising=False)
+    else:
+        monkeypatch.setenv("NBGITPULLER_DOWNLOAD_CHUNK_SIZE", value)
+    assert ph.get_download_chunk_size() == chunk_size
+
+
 def test_extract_file_extension():
     url = "https://example.org/master/materials-sp20-external.tgz"
     ext = ph.extract_file_extension(url)
@@ -42,12 +84,33 @@ def test_extract_file_extension():
 
 
 @pytest.mark.asyncio
-async def test_initialize_local_repo(test_configuration):
+async def test_initialize_local_repo(test_configuration, monkeypatch):
+    monkeypatch.setattr(ph, "pygit2", None)
     yield_str = ""
     for line in ph.initialize_local_repo(origin_repo):
         yield_str += line
     assert "init --bare" in yield_str
     assert os.path.isdir(origin_repo)
+    assert ph.is_initialized_repo(origin_repo)
+
+
+class FakePygit2:
+    def __init__(self):
+        self.initialized = []
+
+    def init_repository(self, path, bare=False, initial_head=None):
+        self.initialized.append((path, bare, initial_head))
+
+
+def test_initialize_local_repo_with_pygit2(test_configuration, monkeypatch):
+    fake_pygit2 = FakePygit2()
+    monkeypatch.setattr(ph, "pygit2", fake_pygit2)
+    yield_str = ""
+    for line in ph.initialize_local_repo(origin_repo):
+        yield_str += line
+    assert "pygit2" in yield_str
+    assert "init --bare" not in yield_str
+    assert fake_pygit2.initialized == [(origin_repo, True, "main")]
 
 
 @pytest.mark.asyncio
@@ -65,9 +128,8 @@ async def test_clone_local_origin_repo(test_configuration):
 
 @pytest.mark.asyncio
 async def test_execute_unarchive(test_configuration):
-    yield_str = ""
-    for line in ph.execute_unarchive("zip", archive_base + ".zip", temp_download_repo):
-        yield_str += line
+    top_level_names = return_value(ph.execute_unarchive("zip", archive_base + ".zip", temp_download_repo))
+    assert top_level_names == ["test.txt"]
     assert os.path.isfile("/tmp/download/test.txt")
 
 
@@ -89,6 +151,7 @@ async def test_push_to_local_origin(test_configuration):
 
 
 @pytest.mark.asyncio
+@responses.activate
 async def test_download_archive(test_configuration):
     args = {"repo": "http://example.org/mocked-download-url"}
     responses.add(responses.GET, args["repo"],
@@ -98,3 +161,430 @@ async def test_download_archive(test_configuration):
         yield_str += line
     assert 'Downloading archive' in yield_str
     assert os.path.isfile(temp_archive_download + "downloaded.zip")
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_progress(test_configuration, monkeypatch):
+    monkeypatch.setattr(ph, "PROGRESS_INTERVAL_BYTES", ph.BYTES_PER_MB)
+    monkeypatch.setattr(ph, "PROGRESS_INTERVAL_SECONDS", 0)
+    args = {"repo": "http://example.org/mocked-large-download-url"}
+    body = b'0' * (3 * ph.BYTES_PER_MB + 10)
+    responses.add(responses.GET, args["repo"], body=body, status=200)
+    yield_str = ""
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        yield_str += line
+    assert yield_str.count("Downloading Progress") == 3
+    assert "Downloading Progress ... 3MB" in yield_str
+    assert os.path.getsize(temp_archive_download + "downloaded.zip") == len(body)
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_stream_download_and_unarchive(test_configuration):
+    args = {"repo": "http://example.org/mocked-download-url.tar.gz"}
+    with open(archive_base + ".tar.gz", "rb") as f:
+        responses.add(responses.GET, args["repo"], body=f.read(), status=200)
+    download_args = {"source_url": args["repo"], "temp_download_file": None}
+    yield_str = ""
+    for line in ph.stream_download_and_unarchive(ph.download_archive, download_args, temp_download_repo):
+        yield_str += line
+    assert "Downloading and unarchiving archive" in yield_str
+    assert os.path.isfile("/tmp/download/test.txt")
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_in_segments(test_configuration, monkeypatch):
+    monkeypatch.setattr(ph, "SEGMENTED_DOWNLOAD_THRESHOLD", 1024)
+    args = {"repo": "http://example.org/mocked-ranged-download-url"}
+    body = bytes(range(256)) * 4099
+
+    def ranged_get(request):
+        start, end = request.headers["Range"].split("=")[1].split("-")
+        return 206, {}, body[int(start):int(end) + 1]
+
+    responses.add(responses.HEAD, args["repo"], status=200,
+                  headers={"Accept-Ranges": "bytes", "Content-Length": str(len(body))})
+    responses.add_callback(responses.GET, args["repo"], callback=ranged_get)
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    assert len(responses.calls) == 1 + ph.DOWNLOAD_SEGMENTS
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_in_segments_resumes_dropped_segment(test_configuration, monkeypatch):
+    monkeypatch.setattr(ph, "SEGMENTED_DOWNLOAD_THRESHOLD", 1024)
+    args = {"repo": "http://example.org/mocked-dropped-ranged-download-url"}
+    body = bytes(range(256)) * 4099
+    dropped = []
+
+    def dropping_get(request):
+        start, end = request.headers["Range"].split("=")[1].split("-")
+        start, end = int(start), int(end)
+        if start == 0 and not dropped:
+            dropped.append(start)
+            return 206, {"Content-Length": str(end + 1)}, body[:10]
+        return 206, {}, body[start:end + 1]
+
+    responses.add(responses.HEAD, args["repo"], status=200,
+                  headers={"Accept-Ranges": "bytes", "Content-Length": str(len(body))})
+    responses.add_callback(responses.GET, args["repo"], callback=dropping_get)
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    assert any(call.request.headers.get("Range", "").startswith("bytes=10-") for call in responses.calls)
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_resumes_partial_file(test_configuration):
+    args = {"repo": "http://example.org/mocked-resumed-download-url"}
+    body = b'Pretend you are zip file being downloaded'
+
+    def ranged_get(request):
+        start = int(request.headers["Range"].split("=")[1].rstrip("-"))
+        return 206, {}, body[start:]
+
+    responses.add_callback(responses.GET, args["repo"], callback=ranged_get)
+    with open(temp_archive_download + "downloaded.zip", "wb") as f:
+        f.write(body[:10])
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    assert responses.calls[-1].request.headers["Range"] == "bytes=10-"
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+@pytest.mark.asyncio
+async def test_clone_local_origin_repo_updates_existing_clone(test_configuration):
+    for line in ph.initialize_local_repo(origin_repo):
+        pass
+    for line in ph.clone_local_origin_repo(origin_repo, temp_download_repo):
+        pass
+    for line in ph.execute_unarchive("zip", archive_base + ".zip", temp_download_repo):
+        pass
+    for line in ph.push_to_local_origin(temp_download_repo):
+        pass
+    with open(temp_download_repo + "untracked.txt", "w") as f:
+        f.write("left over from an earlier pull")
+
+    yield_str = ""
+    for line in ph.clone_local_origin_repo(origin_repo, temp_download_repo):
+        yield_str += line
+
+    assert "git fetch origin" in yield_str
+    assert "Cloning into" not in yield_str
+    assert os.path.isfile(temp_download_repo + "test.txt")
+    assert not os.path.exists(temp_download_repo + "untracked.txt")
+
+
+def test_get_temp_download_parent(monkeypatch):
+    monkeypatch.setenv("NBGITPULLER_TMPDIR", temp_archive_download)
+    assert ph.get_temp_download_parent() == temp_archive_download
+    monkeypatch.delenv("NBGITPULLER_TMPDIR")
+    monkeypatch.setattr(ph, "TMPFS_DIR", "/path/that/does/not/exist")
+    assert ph.get_temp_download_parent(1) is None
+
+
+def test_get_temp_download_parent_checks_download_size(test_configuration, monkeypatch):
+    monkeypatch.delenv("NBGITPULLER_TMPDIR", raising=False)
+    monkeypatch.setattr(ph, "TMPFS_DIR", temp_archive_download)
+    free = shutil.disk_usage(temp_archive_download).free
+    assert ph.get_temp_download_parent() is None
+    assert ph.get_temp_download_parent(free // ph.TMPFS_SIZE_FACTOR) == temp_archive_download
+    assert ph.get_temp_download_parent(free // ph.TMPFS_SIZE_FACTOR + 1) is None
+
+
+def test_get_top_level_names():
+    member_names = ["./", "./materials/", "./materials/a.ipynb", "__MACOSX/._a", ".git/HEAD", "README.md", "materials/b.ipynb"]
+    assert ph.get_top_level_names(member_names) == ["materials", "README.md"]
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_resumes_dropped_connection(test_configuration):
+    args = {"repo": "http://example.org/mocked-dropped-download-url"}
+    body = b'Pretend you are zip file being downloaded'
+
+    def dropping_get(request):
+        if "Range" not in request.headers:
+            return 200, {"Content-Length": str(len(body))}, body[:10]
+        start = int(request.headers["Range"].split("=")[1].rstrip("-"))
+        return 206, {}, body[start:]
+
+    responses.add_callback(responses.GET, args["repo"], callback=dropping_get)
+    yield_str = ""
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        yield_str += line
+    assert "Download interrupted" in yield_str
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+def test_download_progress_waits_for_bytes_and_time(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(ph.time, "monotonic", lambda: clock[0])
+    progress = ph.DownloadProgress()
+    assert progress.message(ph.PROGRESS_INTERVAL_BYTES - 1) is None
+    assert progress.message(ph.PROGRESS_INTERVAL_BYTES) is None
+    clock[0] += ph.PROGRESS_INTERVAL_SECONDS
+    assert progress.message(ph.PROGRESS_INTERVAL_BYTES) == "Downloading Progress ... 16MB\n"
+    clock[0] += ph.PROGRESS_INTERVAL_SECONDS
+    assert progress.message(ph.PROGRESS_INTERVAL_BYTES + 1) is None
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_replaces_file_when_range_is_ignored(test_configuration):
+    args = {"repo": "http://example.org/mocked-unranged-download-url"}
+    body = b'Pretend you are zip file being downloaded'
+    responses.add(responses.GET, args["repo"], body=body, status=200)
+    with open(temp_archive_download + "downloaded.zip", "wb") as f:
+        f.write(b'left over from an earlier download that is longer than the archive')
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_failure_keeps_only_written_bytes(test_configuration):
+    args = {"repo": "http://example.org/mocked-failing-download-url"}
+    body = b'Pretend you are zip file being downloaded'
+
+    def failing_get(request):
+        if "Range" not in request.headers:
+            return 200, {"Content-Length": str(len(body))}, body[:10]
+        raise ph.requests.exceptions.ConnectionError("connection refused")
+
+    responses.add_callback(responses.GET, args["repo"], callback=failing_get)
+    with pytest.raises(ph.requests.exceptions.ConnectionError):
+        for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+            pass
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body[:10]
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_checks_unsatisfiable_range(test_configuration):
+    args = {"repo": "http://example.org/mocked-unsatisfiable-download-url"}
+    body = b'Pretend you are zip file being downloaded'
+
+    def ranged_get(request):
+        if "Range" in request.headers:
+            return 416, {"Content-Range": f"bytes */{len(body)}"}, b''
+        return 200, {}, body
+
+    responses.add_callback(responses.GET, args["repo"], callback=ranged_get)
+    with open(temp_archive_download + "downloaded.zip", "wb") as f:
+        f.write(body)
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    assert responses.calls[-1].request.headers["Range"] == f"bytes={len(body)}-"
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+    with open(temp_archive_download + "downloaded.zip", "wb") as f:
+        f.write(body + b'\0' * 10)
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    assert "Range" not in responses.calls[-1].request.headers
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+@pytest.mark.parametrize("name,link_type,link_name", [
+    ("../outside.txt", ph.tarfile.REGTYPE, ""),
+    ("/tmp/outside.txt", ph.tarfile.REGTYPE, ""),
+    ("link", ph.tarfile.SYMTYPE, "../outside.txt"),
+    ("link", ph.tarfile.LNKTYPE, "/etc/passwd"),
+])
+def test_extract_tar_stream_without_data_filter(test_configuration, monkeypatch, name, link_type, link_name):
+    monkeypatch.delattr(ph.tarfile, "data_filter", raising=False)
+    archive = temp_archive_download + "unsafe.tar"
+    with ph.tarfile.open(archive, "w") as tf:
+        tf.add(test_files_dir + "/test.txt", arcname="test.txt")
+        member = ph.tarfile.TarInfo(name)
+        member.type = link_type
+        member.linkname = link_name
+        tf.addfile(member, ph.io.BytesIO(b""))
+
+    with open(archive, "rb") as f:
+        with pytest.raises(ph.tarfile.TarError):
+            ph.extract_tar_stream(f, "r|*", temp_download_repo)
+    assert not os.path.exists("/tmp/outside.txt")
+
+
+def test_extract_tar_stream_without_data_filter_extracts_safe_archive(test_configuration, monkeypatch):
+    monkeypatch.delattr(ph.tarfile, "data_filter", raising=False)
+    with open(archive_base + ".tar.gz", "rb") as f:
+        assert ph.extract_tar_stream(f, "r|*", temp_download_repo) == ["test.txt"]
+    assert os.path.isfile(temp_download_repo + "test.txt")
+
+
+def test_acquire_file_lock_waits_for_other_holder(test_configuration):
+    lock_path = temp_archive_download + "worktree.lock"
+    with open(lock_path, "a") as first, open(lock_path, "a") as second:
+        assert list(ph.acquire_file_lock(first)) == []
+        waiting = ph.acquire_file_lock(second)
+        assert next(waiting) == "Waiting for another pull of this archive to finish ...\n"
+        first.close()
+        with pytest.raises(StopIteration):
+            next(waiting)
+
+
+class FakeRapidgzip:
+    def __init__(self):
+        self.opened = []
+
+    def open(self, fileobj, parallelization=None):
+        self.opened.append(parallelization)
+        return gzip.GzipFile(fileobj=fileobj)
+
+
+def test_extract_archive_with_rapidgzip(test_configuration, monkeypatch):
+    fake_rapidgzip = FakeRapidgzip()
+    monkeypatch.setattr(ph, "rapidgzip", fake_rapidgzip)
+    monkeypatch.setattr(ph, "PARALLEL_GUNZIP_THRESHOLD", 1)
+    with open(archive_base + ".tar.gz", "rb") as f:
+        assert ph.extract_archive("tgz", f, temp_download_repo) == ["test.txt"]
+    assert fake_rapidgzip.opened == [os.cpu_count()]
+    assert os.path.isfile(temp_download_repo + "test.txt")
+
+
+class GitPullerRef:
+    def __init__(self, git_url, **other_kw_args):
+        self.git_url = git_url
+        self.content_provider = provider
+        self.repo_parent_dir = repo_parent_dir
+        self.other_kw_args = other_kw_args
+
+
+def test_handle_files_helper_streams_small_archives_with_rapidgzip(test_configuration, monkeypatch):
+    monkeypatch.setattr(ph, "rapidgzip", FakeRapidgzip())
+    small = ph.HandleFilesHelper(GitPullerRef(repo_tgz, download_size=ph.PARALLEL_GUNZIP_THRESHOLD - 1))
+    large = ph.HandleFilesHelper(GitPullerRef(repo_tgz, download_size=ph.PARALLEL_GUNZIP_THRESHOLD))
+    unknown = ph.HandleFilesHelper(GitPullerRef(repo_tgz))
+    assert small.stream_download
+    assert not large.stream_download
+    assert unknown.stream_download
+    for hfh in (small, large, unknown):
+        hfh.temp_download_dir.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_download_archive_resumes_stalled_connection(test_configuration, monkeypatch):
+    monkeypatch.setattr(ph, "DOWNLOAD_TIMEOUT", (5, 0.2))
+    # a read only returns once it has a whole chunk, so the server stalls after sending one
+    body = bytes(range(256)) * (ph.DOWNLOAD_CHUNK_SIZE // 128)
+    release = threading.Event()
+
+    class StallingHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if "Range" not in self.headers:
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:ph.DOWNLOAD_CHUNK_SIZE])
+                self.wfile.flush()
+                release.wait(5)  # stall without closing the connection
+                return
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Length", str(len(body) - start))
+            self.end_headers()
+            self.wfile.write(body[start:])
+
+        def do_HEAD(self):
+            self.send_response(405)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StallingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield_str = ""
+        source_url = f"http://127.0.0.1:{server.server_port}/archive.zip"
+        for line in ph.download_archive(source_url, temp_archive_download + "downloaded.zip"):
+            yield_str += line
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+    assert "Download interrupted" in yield_str
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_download_archive_retries_timed_out_request(test_configuration):
+    args = {"repo": "http://example.org/mocked-timed-out-download-url"}
+    body = b'Pretend you are zip file being downloaded'
+    responses.add(responses.GET, args["repo"], body=ph.requests.exceptions.ReadTimeout("read timed out"))
+    responses.add(responses.GET, args["repo"], body=body)
+    for line in ph.download_archive(args["repo"], temp_archive_download + "downloaded.zip"):
+        pass
+    assert all(call.request.req_kwargs["timeout"] == ph.DOWNLOAD_TIMEOUT for call in responses.calls)
+    with open(temp_archive_download + "downloaded.zip", "rb") as f:
+        assert f.read() == body
+
+
+def test_get_local_origin_repo_keeps_legacy_origin(test_configuration):
+    git_puller_ref = GitPullerRef("https://example.org/materials-sp20.zip")
+    hashed_origin = ph.get_local_origin_repo(git_puller_ref)
+    assert hashed_origin.endswith(f"/{provider}/{ph.get_source_path_part(git_puller_ref.git_url)}/")
+
+    legacy_origin = f"{repo_parent_dir}{CACHED_ORIGIN_NON_GIT_REPO}{provider}/httpsexampleorgmaterialssp20zip/"
+    for line in ph.initialize_local_repo(legacy_origin):
+        pass
+    assert ph.get_local_origin_repo(git_puller_ref) == legacy_origin
+
+
+@pytest.mark.asyncio
+async def test_zip_permissions_survive_a_second_pull(test_configuration):
+    archive = temp_archive_download + "modes.zip"
+    with ph.zipfile.ZipFile(archive, "w") as zf:
+        for name, mode in (("read_only.txt", 0o444), ("script.sh", 0o755)):
+            info = ph.zipfile.ZipInfo(name)
+            info.external_attr = (0o100000 | mode) << 16
+            zf.writestr(info, f"{name} contents")
+
+    for line in ph.initialize_local_repo(origin_repo):
+        pass
+    for pull in range(2):
+        for line in ph.clone_local_origin_repo(origin_repo, temp_download_repo):
+            pass
+        for line in ph.execute_unarchive("zip", archive, temp_download_repo):
+            pass
+        for line in ph.push_to_local_origin(temp_download_repo):
+            pass
+        assert os.stat(temp_download_repo + "read_only.txt").st_mode & 0o200
+        assert os.stat(temp_download_repo + "script.sh").st_mode & 0o100
+
+
+@pytest.mark.asyncio
+@responses.activate
+async def test_handle_files_helper_probes_download_once(test_configuration):
+    source_url = "http://example.org/mocked-probed-download-url.zip"
+    with open(archive_base + ".zip", "rb") as f:
+        body = f.read()
+    responses.add(responses.HEAD, source_url, status=200, headers={"Content-Length": str(len(body))})
+    responses.add(responses.GET, source_url, body=body)
+    hfh = ph.HandleFilesHelper(GitPullerRef(source_url))
+    assert hfh.download_size == len(body)
+    output_info = return_value(hfh.handle_files_helper())
+    assert output_info["source_dir_name"] == "test.txt"
+    assert [call.request.method for call in responses.calls] == ["HEAD", "GET"]